@@ -0,0 +1,70 @@
+import numpy as np
+
+try:
+    from numba import njit, prange
+
+    NUMBA_AVAILABLE: bool = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+
+PROFILE_BLOCK: int = 256
+
+if NUMBA_AVAILABLE:
+
+    # Compiled eagerly for the only argument types used, so the first query does not
+    # pay for compilation and other types are rejected instead of recompiled.
+    @njit(
+        "void(int32[::1], int64[::1], int32[:, ::1], int32[::1], int32[::1], int64, int64)",
+        cache=True,
+        parallel=True,
+    )
+    def scan(
+        query: np.ndarray,
+        loci: np.ndarray,
+        references: np.ndarray,
+        out_identical: np.ndarray,
+        out_skipped: np.ndarray,
+        gathering_threshold: int,
+        max_missing_loci: int,
+    ) -> None:
+        """Count the identical and skipped query loci against each reference profile."""
+        # Blocks are walked a locus at a time and abandoned once every profile is past
+        # either limit. Abandoned profiles are reported with every locus skipped.
+        scheme_size, n_profiles = references.shape
+        query_missing = scheme_size - loci.shape[0]
+        for block in prange((n_profiles + PROFILE_BLOCK - 1) // PROFILE_BLOCK):
+            start = block * PROFILE_BLOCK
+            end = min(start + PROFILE_BLOCK, n_profiles)
+            identical = np.zeros(end - start, dtype=np.int32)
+            mismatches = np.zeros(end - start, dtype=np.int32)
+            skipped = np.full(end - start, query_missing, dtype=np.int32)
+            for i in range(loci.shape[0]):
+                locus = loci[i]
+                q_allele = query[i]
+                live = False
+                for p in range(start, end):
+                    k = p - start
+                    r_allele = references[locus, p]
+                    # 0 is the missing allele sentinel
+                    if r_allele == 0:
+                        skipped[k] += 1
+                    elif q_allele == r_allele:
+                        identical[k] += 1
+                    else:
+                        mismatches[k] += 1
+                    if (
+                        skipped[k] <= max_missing_loci
+                        and mismatches[k] <= gathering_threshold
+                    ):
+                        live = True
+                if not live:
+                    break
+            for p in range(start, end):
+                k = p - start
+                if skipped[k] > max_missing_loci or mismatches[k] > gathering_threshold:
+                    out_identical[p] = 0
+                    out_skipped[p] = scheme_size
+                else:
+                    out_identical[p] = identical[k]
+                    out_skipped[p] = skipped[k]
@@ -1,47 +1,87 @@
-import sqlite3
+import dataclasses
 from pathlib import Path
+from typing import Iterable
 
+import numpy as np
 
-def connect_db(db_file: str) -> sqlite3.Connection:
-    return sqlite3.connect(db_file)
+POSITION_BYTES: int = 2
+CODE_BYTES: int = 4
 
 
-def initialise_db(file: str|Path) -> sqlite3.Connection:
-    conn: sqlite3.Connection = sqlite3.connect(file)
-    cursor: sqlite3.Cursor = conn.cursor()
+def checksum_key(hex_digest: str, hash_size: int) -> bytes:
+    """Truncate a hex digest to hash_size characters, rounded up to whole bytes."""
+    return bytes.fromhex(hex_digest[: hash_size + hash_size % 2])
 
-    cursor.execute("PRAGMA journal_mode=WAL")
-    cursor.execute("PRAGMA synchronous=OFF")
 
-    cursor.execute(
-        "CREATE TABLE IF NOT EXISTS alleles(checksum TEXT, position INTEGER, code INTEGER)"
+def pack_allele(checksum: bytes, position: int, code: int = 0) -> bytes:
+    """Pack an allele so that its bytes sort by (position, checksum)."""
+    return (
+        position.to_bytes(POSITION_BYTES, "big")
+        + checksum
+        + code.to_bytes(CODE_BYTES, "big")
     )
-    cursor.execute("DELETE FROM alleles")
-    cursor.execute("DROP INDEX IF EXISTS idx_checksum")
 
-    cursor.close()
-    conn.commit()
-    return conn
 
+def write_allele_index(
+    file: Path, alleles: Iterable[tuple[bytes, int, int]], hash_size: int
+) -> None:
+    """Write the alleles as a sorted uint8 matrix of packed rows."""
+    width: int = POSITION_BYTES + (hash_size + 1) // 2 + CODE_BYTES
+    rows: np.ndarray = np.frombuffer(
+        b"".join(pack_allele(*allele) for allele in alleles), dtype=np.uint8
+    ).reshape(-1, width)
+    rows = rows[np.argsort(rows.view(f"S{width}").ravel(), kind="stable")]
+    # Keep the first row of each duplicated (position, checksum)
+    keys: np.ndarray = rows[:, :-CODE_BYTES]
+    first: np.ndarray = np.ones(len(rows), dtype=bool)
+    first[1:] = (keys[1:] != keys[:-1]).any(axis=1)
+    with open(file, "wb") as index_fh:
+        np.save(index_fh, np.ascontiguousarray(rows[first]))
 
-def finalise_db(db: sqlite3.Connection) -> None:
-    cursor: sqlite3.Cursor = db.cursor()
-    cursor.execute(
-        "CREATE INDEX IF NOT EXISTS idx_checksum ON alleles(checksum, position)"
-    )
-    cursor.execute("VACUUM")
-    cursor.execute("ANALYZE")
-    cursor.execute("PRAGMA optimize")
-    cursor.execute("PRAGMA query_only = ON")  # Set to read-only mode
-    db.commit()
-    cursor.close()
-
-
-def lookup_st(cursor: sqlite3.Cursor, checksum: str, position: int) -> int | None:
-    result: tuple[int] | None = next(
-        cursor.execute(
-            "SELECT code FROM alleles WHERE checksum =? AND position =?", (checksum, position)
-        ),
-        None,
-    )
-    return result[0] if result is not None else None
+
+@dataclasses.dataclass
+class AlleleIndex:
+    rows: np.ndarray
+
+    def __post_init__(self) -> None:
+        # Each row as one fixed-width byte string, without copying the map
+        self.keys: np.ndarray = self.rows.view(f"S{self.rows.shape[1]}").ravel()
+
+    @classmethod
+    def load(cls, file: Path, hash_size: int) -> "AlleleIndex":
+        index: AlleleIndex = cls(np.load(file, mmap_mode="r"))
+        if index.checksum_bytes != (hash_size + 1) // 2:
+            # Odd hash sizes are rounded up to whole bytes, so two sizes share a width
+            built: str = f"{index.checksum_bytes * 2 - 1} or {index.checksum_bytes * 2}"
+            raise ValueError(
+                f"Allele index was built with hash size {built}, not {hash_size}"
+            )
+        return index
+
+    @property
+    def checksum_bytes(self) -> int:
+        return self.rows.shape[1] - POSITION_BYTES - CODE_BYTES
+
+    def lookup(self, alleles: list[tuple[bytes, int]]) -> dict[tuple[bytes, int], int]:
+        """Look up the codes of many (checksum, position) pairs in one search."""
+        if not alleles or len(self.rows) == 0:
+            return {}
+        queries: np.ndarray = np.frombuffer(
+            b"".join(pack_allele(checksum, position) for checksum, position in alleles),
+            dtype=np.uint8,
+        ).reshape(len(alleles), -1)
+        found: np.ndarray = np.minimum(
+            np.searchsorted(self.keys, queries.view(self.keys.dtype).ravel()),
+            len(self.rows) - 1,
+        )
+        candidates: np.ndarray = self.rows[found]
+        hits: np.ndarray = (
+            candidates[:, :-CODE_BYTES] == queries[:, :-CODE_BYTES]
+        ).all(axis=1)
+        codes: np.ndarray = (
+            np.ascontiguousarray(candidates[:, -CODE_BYTES:]).view(">i4").ravel()
+        )
+        return {
+            alleles[i]: code
+            for i, code in zip(np.flatnonzero(hits).tolist(), codes[hits].tolist())
+        }
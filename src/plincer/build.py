@@ -4,27 +4,58 @@ import gzip
 import io
 import json
 import logging
-import lzma
+import multiprocessing
 import re
 import shutil
+import threading
+from concurrent.futures import (
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
 from datetime import datetime
 from functools import partial
 from hashlib import sha1
 from pathlib import Path
 from typing import Annotated, Any, Callable, Iterable, Iterator, Optional, TextIO
 
+import numpy as np
 import requests
 import toml
 import typer
-from Bio import SeqIO
-from Bio.Seq import Seq
-from Bio.SeqRecord import SeqRecord
+from Bio.SeqIO.FastaIO import SimpleFastaParser
 from rauth import OAuth1Session
-
-from plincer.allelestore import finalise_db, initialise_db
+from requests.adapters import HTTPAdapter
+from tenacity import (
+    retry,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_exponential,
+)
+from urllib3.util import Retry
+
+from plincer.allelestore import write_allele_index
 from plincer.keycache import KeyCache
-
-BAD_CHAR: re.Pattern = re.compile(r"[^ACGT]")
+from plincer.profilestore import encode_alleles, encode_lincodes, write_profiles
+
+# Lowercases ACGT and maps any other byte to NUL, to normalise and validate in one pass
+NORMALISE_BASES: bytes = bytes(
+    b if b in b"acgt" else b + 32 if b in b"ACGT" else 0 for b in range(256)
+)
+# An optional locus name prefix and the numeric allele id
+ALLELE_NAME: re.Pattern = re.compile(r"^(?:.+[_-])?([0-9]+)$")
+DOWNLOAD_WORKERS: int = 5  # Kept low to respect the host's rate limits
+SESSION_KEY_LOCK: threading.Lock = threading.Lock()
+# Sessions are reused to keep connections alive, but are not thread-safe
+THREAD_SESSIONS: threading.local = threading.local()
+REQUEST_TIMEOUT: float = 60  # Seconds to wait to connect or between reads
+AUTH_ATTEMPTS: int = 3  # Requests with regenerated keys before giving up
+# Transient server errors are retried, backing off 0.5s, 1s, 2s, ...
+SERVER_RETRIES: Retry = Retry(
+    total=5, backoff_factor=0.5, status_forcelist=[502, 503, 504]
+)
 
 app: typer.Typer = typer.Typer()
 
@@ -42,16 +73,16 @@ def build(
             dir_okay=False,
         ),
     ] = Path("scheme.toml"),
-    profiles_json: Annotated[
+    profiles_file: Annotated[
         Path,
         typer.Option(
             "-o",
             "--profiles-file",
-            help="Output Profiles JSON file path",
+            help="Output Profiles NPZ file path",
             file_okay=True,
             dir_okay=False,
         ),
-    ] = Path("profiles.json.xz"),
+    ] = Path("profiles.npz"),
     scheme_metadata: Annotated[
         Path,
         typer.Option(
@@ -67,11 +98,11 @@ def build(
         typer.Option(
             "-a",
             "--alleles-db",
-            help="Output location of the sqlite allele DB",
+            help="Output location of the allele index",
             file_okay=True,
             dir_okay=False,
         ),
-    ] = Path("alleles.sqlite"),
+    ] = Path("alleles.npy"),
     secrets_file: Annotated[
         Path,
         typer.Option(
@@ -119,9 +150,16 @@ def build(
         typer.Option(
             "-z",
             "--hash-size",
-            help="Size of the hash to generate (default: 15)",
+            help="Size of the hash to generate in hex characters, rounded up to whole bytes (default: 15)",
         ),
     ] = 15,
+    keep_fasta: Annotated[
+        bool,
+        typer.Option(
+            help="Also write the normalised allele FASTA files to the scratch directory (use with --no-clean)",
+            is_flag=True,
+        ),
+    ] = False,
     clean: Annotated[
         bool,
         typer.Option(
@@ -158,9 +196,7 @@ def build(
         shutil.rmtree(scratch_dir)
     scratch_dir.mkdir(parents=True)
 
-    with open(scheme_toml, "r") as sch_fh, lzma.open(
-        profiles_json, "w"
-    ) as profiles_fh, open(scheme_metadata, "w") as metadata_fh:
+    with open(scheme_toml, "r") as sch_fh, open(scheme_metadata, "w") as metadata_fh:
         scheme: dict[str, Any] = toml.load(sch_fh)
         logger.info(f"Fetching scheme {scheme['name']}")
 
@@ -172,28 +208,30 @@ def build(
         logger.info("Fetching loci...")
         loci: list[str] = downloader.download_loci()
         logger.debug(f"Found {len(loci)} loci")
-        scheme_metadata: dict[str, Any] = downloader.build_metadata(loci)
-        json.dump(scheme_metadata, metadata_fh)
+        metadata: dict[str, Any] = downloader.build_metadata(loci)
+        json.dump(metadata, metadata_fh)
         logger.debug(f"Metadata written to {scheme_metadata}")
 
-        logger.info(f"Downloading alleles for {len(loci)} loci ...")
-        downloader.download_alleles(loci, scratch_dir)
-        logger.debug(f"Done: {json.dumps(scheme_metadata, indent=4)}")
-        logger.info(f"Creating allele DB at {dbfile} with hash size {hash_size}...")
-        create_allele_db(loci, scratch_dir, dbfile, hash_size)
+        logger.info(
+            f"Downloading alleles for {len(loci)} loci into an allele DB at {dbfile} with hash size {hash_size}..."
+        )
+        create_allele_db(
+            downloader.download_alleles(loci, scratch_dir if keep_fasta else None),
+            dbfile,
+            hash_size,
+        )
         logger.debug(f"Allele DB created at {dbfile}")
 
         logger.info("Downloading profiles...")
-        raw_profiles: str = downloader.download_profiles()
-        logger.debug(f"Downloaded profiles: {len(raw_profiles)} bytes")
-        with open(f"{scratch_dir}/profiles.tsv", "w") as temp_fh:
-            temp_fh.write(raw_profiles)
-        profiles: dict[str, dict[str, str]] = parse_profile_csv(raw_profiles)
-        logger.debug(f"Parsed {len(profiles)} profiles")
+        # Only keep a copy of the raw profiles when debugging
+        profiles: dict[str, np.ndarray] = downloader.download_profiles(
+            scratch_dir / "profiles.tsv" if logger.isEnabledFor(logging.DEBUG) else None
+        )
+        logger.debug(f"Parsed {len(profiles['sts'])} profiles")
 
-        logger.debug("Converting LIN codes and writing to output file...")
-        profiles_fh.write(json.dumps(profiles).encode("utf-8"))
-        logger.debug(f"Profiles written to {str(profiles_json)}")
+        logger.debug("Writing profiles to output file...")
+        write_profiles(profiles_file, profiles)
+        logger.debug(f"Profiles written to {str(profiles_file)}")
 
     if clean:
         logger.info(f"Cleaning scratch directory {str(scratch_dir)}")
@@ -205,27 +243,30 @@ def build(
 def normalise_fasta(input_text: str, output_stream: TextIO) -> list[str]:
     contig_names: list[str] = []
 
-    for record in SeqIO.parse(io.StringIO(input_text), "fasta"):
-        name: str = record.id
-        sequence: str = str(record.seq).upper()
+    for title, sequence in SimpleFastaParser(io.StringIO(input_text)):
+        # The record id, as SeqIO would take it
+        name: str = title.split(maxsplit=1)[0] if title.strip() else ""
+        # Lowercase, as the Pathogenwatch cgMLST hashes are of lowercase sequences
+        bases: bytes = sequence.encode("ascii", errors="replace").translate(
+            NORMALISE_BASES
+        )
 
-        m: Optional[re.Match] = re.match(r"^(.+[_-])?([0-9]+(\\.[0-9]+)?)$", name)
+        m: Optional[re.Match] = ALLELE_NAME.match(name)
         if m is None:
             print(f"Skipping badly formatted allele '{name}'")
             continue
 
-        if BAD_CHAR.search(sequence):
+        if b"\x00" in bases:
             # Some schemes had non-ACGT characters
             continue
 
-        if len(sequence.strip()) == 0:
+        if len(bases) == 0:
             # pubmlst_neisseria_62/NEIS1690.fa.gz has an allele with
             # no content. I assume it is because it needs to be removed
             continue
 
-        normalized_record: SeqRecord = SeqRecord(Seq(sequence), id=m[2], description="")
-        SeqIO.write(normalized_record, output_stream, "fasta")
-        contig_names.append(m[2])
+        output_stream.write(f">{m[1]}\n{bases.decode('ascii')}\n")
+        contig_names.append(m[1])
 
     if len(contig_names) == 0:
         raise ValueError("Expected there to be some contigs")
@@ -253,26 +294,38 @@ class Downloader:
             oauth_fetch, self.host, self.keycache, self.database
         )
 
-    def download_profiles(self) -> str:
-        response: requests.Response = self.__oauth_fetch(
-            f"{self.scheme_url}/profiles_csv"
-        )
-        if response.status_code == 200:
-            logging.debug("Downloaded profiles successfully")
-            return response.text
-        else:
-            raise Exception(
-                f"Failed to download profiles: HTTP status {response.status_code}"
-            )
+    # Failed requests are already retried by the session, so only a stream broken
+    # while it is being parsed is downloaded again
+    @retry(
+        retry=retry_if_exception_type(
+            (requests.ConnectionError, requests.exceptions.ChunkedEncodingError)
+        ),
+        wait=wait_exponential(multiplier=2, max=60),
+        stop=stop_after_attempt(3),
+        reraise=True,
+    )
+    def download_profiles(self, copy_file: Path | None = None) -> dict[str, np.ndarray]:
+        with self.__oauth_fetch(
+            f"{self.scheme_url}/profiles_csv", stream=True
+        ) as response:
+            if response.status_code != 200:
+                raise requests.HTTPError(
+                    f"Failed to download profiles: HTTP status {response.status_code}",
+                    response=response,
+                )
+            logging.debug("Streaming profiles")
+            response.encoding = "utf-8"
+            lines: Iterator[str] = response.iter_lines(decode_unicode=True)
+            if copy_file is None:
+                return parse_profile_csv(lines)
+            with open(copy_file, "w") as copy_fh:
+                return parse_profile_csv(tee_lines(lines, copy_fh))
 
     def download_loci(self) -> list[str]:
         logging.debug(f"Downloading loci for {self.name}...")
         r: requests.Response = self.__oauth_fetch(self.loci_url)
-        loci: list[str] = []
         stem: str = f"{self.alleles_url}/"
-        for locus in json.loads(r.text)["loci"]:
-            loci.append(locus.replace(stem, ""))
-        return loci
+        return [locus.removeprefix(stem) for locus in json.loads(r.text)["loci"]]
 
     def fetch_timestamp(self) -> str:
         logging.debug(f"Fetching timestamp for {self.name}...")
@@ -292,91 +345,174 @@ class Downloader:
         }
         return scheme_metadata
 
-    def download_alleles(self, loci: list[str], out_dir: Path) -> None:
-        for locus in loci:
-            alleles_url: str = f"{self.alleles_url}/{locus}/alleles_fasta"
-            logging.debug(f"Downloading alleles for {locus} from {alleles_url}")
-
+    def download_alleles(
+        self, loci: list[str], fasta_dir: Path | None = None
+    ) -> Iterator[tuple[int, str]]:
+        """Yield the (position, normalised FASTA) of each locus as it downloads."""
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+            futures: dict[Future, int] = {
+                executor.submit(self.download_locus, locus, fasta_dir): idx
+                for idx, locus in enumerate(loci)
+            }
+            try:
+                for count, future in enumerate(as_completed(futures), start=1):
+                    # Drop the reference so the text is freed once it has been hashed
+                    idx: int = futures.pop(future)
+                    logging.debug(
+                        f"Downloaded alleles for {loci[idx]} ({count}/{len(loci)})"
+                    )
+                    yield idx, future.result()
+            finally:
+                # Don't start the queued downloads after a failure or an early close
+                executor.shutdown(cancel_futures=True)
+
+    def download_locus(self, locus: str, fasta_dir: Path | None = None) -> str:
+        alleles_url: str = f"{self.alleles_url}/{locus}/alleles_fasta"
+        logging.debug(f"Downloading alleles for {locus} from {alleles_url}")
+        response = self.__oauth_fetch(alleles_url)
+        normalised: io.StringIO = io.StringIO()
+        normalise_fasta(response.text, normalised)
+
+        if fasta_dir is not None:
             # PubMLST puts an apostrophe in front of RNA genes, it seems
             clean_locus: str = locus.replace("'", "")
-            allele_file: Path = Path(f"{out_dir}/{clean_locus}.fa.gz")
-            # Remove any existing file to deal with failed downloads.
-            allele_file.unlink(missing_ok=True)
-            with gzip.open(allele_file, "wt") as out_f:
-                response = self.__oauth_fetch(alleles_url)
-                normalise_fasta(response.text, out_f)
+            with gzip.open(fasta_dir / f"{clean_locus}.fa.gz", "wt") as out_f:
+                out_f.write(normalised.getvalue())
+        return normalised.getvalue()
 
 
 def create_allele_db(
-    genes: list[str], alleles_dir: Path, dbfile: Path, hash_size: int = 20
+    alleles: Iterable[tuple[int, str]], dbfile: Path, hash_size: int = 20
 ) -> None:
-    db = initialise_db(dbfile)
-    cursor = db.cursor()
-    for idx, gene in enumerate(genes):
-        filename: Path = alleles_dir / f"{gene}.fa.gz"
-        cursor.executemany(
-            "INSERT INTO alleles(checksum, position, code) VALUES(?,?,?)",
-            hash_alleles(filename, idx, hash_size),
-        )
-    db.commit()
-    cursor.close()
-    finalise_db(db)
+    write_allele_index(dbfile, hash_loci(alleles, hash_size), hash_size)
+
+
+def hash_loci(
+    alleles: Iterable[tuple[int, str]], hash_size: int = 20
+) -> Iterator[tuple[bytes, int, int]]:
+    """Hash each (position, FASTA) locus in a worker process as it arrives."""
+    # Forking once the download threads have started can deadlock
+    with ProcessPoolExecutor(
+        mp_context=multiprocessing.get_context("forkserver")
+    ) as executor:
+        pending: set[Future] = set()
+        for idx, fasta in alleles:
+            pending.add(executor.submit(hash_locus, fasta, idx, hash_size))
+            done, pending = wait(pending, timeout=0)
+            for future in done:
+                yield from future.result()
+        for future in as_completed(pending):
+            yield from future.result()
+
+
+def hash_locus(
+    fasta: str, idx: int, hash_size: int = 20
+) -> list[tuple[bytes, int, int]]:
+    return list(hash_alleles(fasta, idx, hash_size))
 
 
 def hash_alleles(
-    filename: Path, idx: int, hash_size: int = 20
-) -> Iterator[tuple[str, int, int]]:
-    with gzip.open(filename, "rt", encoding="utf-8") as fasta_fh:
-        for record in SeqIO.parse(fasta_fh, "fasta"):
-            code: int = int(record.id)
-            sequence: str = str(record.seq).lower()
-            yield sha1(sequence.encode()).hexdigest()[:hash_size], idx, code
+    fasta: str, idx: int, hash_size: int = 20
+) -> Iterator[tuple[bytes, int, int]]:
+    # Raw digest bytes, matching checksum_key() on the hex digest
+    digest_size: int = (hash_size + 1) // 2
+    # Normalised FASTA has numeric ids and lowercase sequences, so it is hashed as read
+    for title, sequence in SimpleFastaParser(io.StringIO(fasta)):
+        yield sha1(sequence.encode("ascii")).digest()[:digest_size], idx, int(title)
 
 
 def oauth_fetch(
-    host: str, keycache: KeyCache, database: str, url: str
+    host: str,
+    keycache: KeyCache,
+    database: str,
+    url: str,
+    stream: bool = False,
+    timeout: float = REQUEST_TIMEOUT,
 ) -> requests.Response:
     logging.debug(f"Fetching data from authenticated {host} - {database}...")
-    consumer_key: tuple[str, str] = keycache.get_consumer_key(host)
-    session_key: tuple[str, str] = keycache.get_session_key(host, database)
-    session: OAuth1Session = OAuth1Session(
-        consumer_key[0],
-        consumer_key[1],
-        access_token=session_key[0],
-        access_token_secret=session_key[1],
+    sessions: dict[tuple[str, str], tuple[OAuth1Session, tuple[str, str]]] | None = (
+        getattr(THREAD_SESSIONS, "sessions", None)
     )
-    response: requests.Response = session.get(url)
-    if response.status_code == 301 or response.status_code == 401:
+    if sessions is None:
+        sessions = THREAD_SESSIONS.sessions = {}
+    for _ in range(AUTH_ATTEMPTS):
+        if (host, database) not in sessions:
+            sessions[(host, database)] = oauth_session(host, keycache, database)
+        session, session_key = sessions[(host, database)]
+        response: requests.Response = session.get(url, stream=stream, timeout=timeout)
+        if response.status_code != 301 and response.status_code != 401:
+            response.raise_for_status()
+            return response
         logging.error(
             f"Session access denied. Attempting to regenerate keys as needed for {host}"
         )
-        keycache.delete_key("session", host)
-        response = oauth_fetch(host, keycache, database, url)
-    else:
-        response.raise_for_status()
-    return response
+        del sessions[(host, database)]
+        with SESSION_KEY_LOCK:
+            # Another thread may have already replaced the rejected key
+            if keycache.get_key("session", host) == session_key:
+                keycache.delete_key("session", host)
+    raise requests.HTTPError(
+        f"Access to {host} - {database} still denied after {AUTH_ATTEMPTS} attempts",
+        response=response,
+    )
 
 
-def parse_profile_csv(profile_csv: str) -> dict[str, dict[str, str]]:
-    reader: Iterable[list[str]] = csv.reader(
-        profile_csv.splitlines()[1:], delimiter="\t"
+def oauth_session(
+    host: str, keycache: KeyCache, database: str
+) -> tuple[OAuth1Session, tuple[str, str]]:
+    """Create a session signed with the current keys, returned with its session key."""
+    # Only one download thread fetches a missing session key
+    with SESSION_KEY_LOCK:
+        consumer_key: tuple[str, str] = keycache.get_consumer_key(host)
+        session_key: tuple[str, str] = keycache.get_session_key(host, database)
+    session: OAuth1Session = OAuth1Session(
+        consumer_key[0],
+        consumer_key[1],
+        access_token=session_key[0],
+        access_token_secret=session_key[1],
     )
-    profiles: dict[str, dict[str, str]] = dict()
+    session.mount("https://", HTTPAdapter(max_retries=SERVER_RETRIES))
+    return session, session_key
+
+
+def tee_lines(lines: Iterable[str], out: TextIO) -> Iterator[str]:
+    """Yield the lines, writing a copy of each to the output stream."""
+    for line in lines:
+        out.write(f"{line}\n")
+        yield line
+
+
+def parse_profile_csv(profile_lines: Iterable[str]) -> dict[str, np.ndarray]:
+    """Parse the profiles CSV into the columns of the profile store."""
+    reader: Iterator[list[str]] = csv.reader(profile_lines, delimiter="\t")
+    columns: int = len(next(reader))
+    sts: list[str] = []
+    alleles: list[str] = []
+    lincodes: list[str] = []
+    sublineages: list[str] = []
+    clonal_groups: list[str] = []
     for row in reader:
-        st: str = row[0]
-        profile: list[str] = row[1:-4]
-        lincode: str
-        phylogroup: str
-        sublineage: str
-        clonal_group: str
-        lincode, phylogroup, sublineage, clonal_group = row[-4:]
-        if lincode != "":
-            profiles[st] = {
-                "ST": st,
-                "profile": profile,
-                "LINcode": lincode.split("_"),
-                "Phylogroup": phylogroup,
-                "Clonal Group": clonal_group.replace("CG", ""),
-                "Sublineage": sublineage.replace("SL", ""),
-            }
-    return profiles
+        # The last four columns are LINcode, Phylogroup, Sublineage and Clonal Group
+        if not row or row[-4] == "":
+            continue
+        if len(row) != columns:
+            raise ValueError(
+                f"Profile for ST {row[0]} has {len(row)} columns, expected {columns}"
+            )
+        sts.append(row[0])
+        alleles.extend(row[1:-4])
+        lincodes.append(row[-4])
+        sublineages.append(row[-2])
+        clonal_groups.append(row[-1])
+    if not sts:
+        raise ValueError("No profiles with a LINcode found in the profiles CSV")
+    return {
+        "sts": np.array(sts),
+        # Loci-major, so that each locus is contiguous across the profiles
+        "profiles": np.ascontiguousarray(
+            encode_alleles(np.array(alleles)).reshape(len(sts), columns - 5).T
+        ),
+        "lincodes": encode_lincodes(lincodes),
+        "sublineages": np.strings.replace(np.array(sublineages), "SL", ""),
+        "clonal_groups": np.strings.replace(np.array(clonal_groups), "CG", ""),
+    }
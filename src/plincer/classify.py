@@ -1,19 +1,62 @@
-import json
-import lzma
+import bisect
 import math
-import sqlite3
 import sys
 from functools import partial
 from pathlib import Path
-from typing import Annotated, Any, Callable
+from typing import Annotated, Any
 
+import numpy as np
+import orjson
 import toml
 import typer
 
-from plincer.allelestore import connect_db, lookup_st
+from plincer import _kernels
+from plincer.allelestore import AlleleIndex, checksum_key
+from plincer.profilestore import (
+    MAX_ALLELE,
+    MISSING_ALLELE,
+    NOVEL_ALLELE,
+    ProfileStore,
+    decode_lincode,
+    pack_missing_loci,
+)
 
 app = typer.Typer()
 
+SchemeFileOption = Annotated[
+    Path,
+    typer.Option(
+        "-s",
+        "--scheme-file",
+        help="Scheme TOML file path",
+        file_okay=True,
+        exists=True,
+        dir_okay=False,
+    ),
+]
+ProfilesFileOption = Annotated[
+    Path,
+    typer.Option(
+        "-p",
+        "--profiles-file",
+        help="Profiles NPZ file path",
+        file_okay=True,
+        exists=True,
+        dir_okay=False,
+    ),
+]
+AlleleDbOption = Annotated[
+    Path,
+    typer.Option(
+        "-a",
+        "--alleles-db",
+        help="Allele index file path",
+        file_okay=True,
+        exists=True,
+        dir_okay=False,
+    ),
+]
+
 
 @app.command()
 def classify(
@@ -22,39 +65,9 @@ def classify(
         typer.Argument(
             help="Input JSON file path with a Pathogenwatch cgMLST profile. Provide a '-' to read from stdin.",
     )],
-    scheme_toml: Annotated[
-        Path,
-        typer.Option(
-            "-s",
-            "--scheme-file",
-            help="Scheme TOML file path",
-            file_okay=True,
-            exists=True,
-            dir_okay=False,
-        ),
-    ] = Path("scheme.toml"),
-    profiles_json: Annotated[
-        Path,
-        typer.Option(
-            "-p",
-            "--profiles-file",
-            help="Profiles JSON file path",
-            file_okay=True,
-            exists=True,
-            dir_okay=False,
-        ),
-    ] = Path("profiles.json.xz"),
-    allele_db: Annotated[
-        Path,
-        typer.Option(
-            "-a",
-            "--alleles-db",
-            help="Alleles DB file path",
-            file_okay=True,
-            exists=True,
-            dir_okay=False,
-        ),
-    ] = Path("alleles.sqlite"),
+    scheme_toml: SchemeFileOption = Path("scheme.toml"),
+    profiles_file: ProfilesFileOption = Path("profiles.npz"),
+    allele_db: AlleleDbOption = Path("alleles.npy"),
     hash_size: int = 15,
 ):
     if input == "-":
@@ -64,94 +77,133 @@ def classify(
         if not infile.is_file():
             typer.echo(f"Error: Input file '{infile}' does not exist.")
             sys.exit(1)
-        with open(infile, "r") as infile_fh:
-            input_json: dict[str, Any] = json.load(infile_fh)
+        input_json: dict[str, Any] = orjson.loads(infile.read_bytes())
+
+    result: dict[str, Any] = classify_profile(
+        input_json,
+        ProfileStore.load(profiles_file),
+        load_scheme(scheme_toml),
+        AlleleIndex.load(allele_db, hash_size),
+        hash_size,
+    )
+    sys.stdout.buffer.write(orjson.dumps(result, option=orjson.OPT_APPEND_NEWLINE))
+
+
+@app.command()
+def serve(
+    scheme_toml: SchemeFileOption = Path("scheme.toml"),
+    profiles_file: ProfilesFileOption = Path("profiles.npz"),
+    allele_db: AlleleDbOption = Path("alleles.npy"),
+    hash_size: int = 15,
+):
+    """Classify newline-delimited profile JSON from stdin, one result line each."""
+    alleles: AlleleIndex = AlleleIndex.load(allele_db, hash_size)
+    profiles: ProfileStore = ProfileStore.load(profiles_file)
+    scheme: dict[str, Any] = load_scheme(scheme_toml)
+    for line in sys.stdin.buffer:
+        if not line.strip():
+            continue
+        try:
+            result: dict[str, Any] = classify_profile(
+                orjson.loads(line), profiles, scheme, alleles, hash_size
+            )
+        except (
+            orjson.JSONDecodeError,
+            KeyError,
+            TypeError,
+            ValueError,
+            OverflowError,
+        ) as e:
+            # Report a bad input in place of its result and carry on with the rest
+            result = {"error": f"{type(e).__name__}: {e}"}
+        sys.stdout.buffer.write(orjson.dumps(result, option=orjson.OPT_APPEND_NEWLINE))
+        sys.stdout.buffer.flush()
 
-    db: sqlite3.Connection = connect_db(str(allele_db))
-    cursor: sqlite3.Cursor = db.cursor()
-    lookup: Callable[[str, int], int] = partial(lookup_st, cursor)
 
-    profile: list[str] = []
-    for index, locus in enumerate(input_json["code"].split("_")):
+def load_scheme(scheme_toml: Path) -> dict[str, Any]:
+    with open(scheme_toml, "r") as scheme_fh:
+        scheme: dict[str, Any] = toml.load(scheme_fh)
+    scheme["level_thresholds"] = level_thresholds(scheme["levels"])
+    return scheme
+
+
+def build_query_profile(
+    code: str, alleles: AlleleIndex, hash_size: int
+) -> list[int]:
+    loci: list[str] = code.split("_")
+    keys: dict[int, tuple[bytes, int]] = {}
+    for index, locus in enumerate(loci):
+        if not locus.isdigit() and len(locus) == 40:
+            try:
+                keys[index] = (checksum_key(locus, hash_size), index)
+            except ValueError:
+                # Not a hex checksum, so it is left as a novel allele
+                pass
+    known_alleles: dict[tuple[bytes, int], int] = alleles.lookup(list(keys.values()))
+    profile: list[int] = []
+    for index, locus in enumerate(loci):
         if locus.isdigit():
-            profile.append(locus)
+            allele: int = int(locus)
+            # Ids beyond int32 cannot be in the store, so they can only be novel
+            profile.append(allele if allele <= MAX_ALLELE else NOVEL_ALLELE)
         elif locus == "":
-            profile.append("")
+            profile.append(MISSING_ALLELE)
         elif len(locus) == 40:
-            result: int | None = lookup(locus[0:hash_size], index)
-            if result:
-                profile.append(str(result))
-            else:
-                profile.append(str(sys.maxsize))
+            profile.append(known_alleles.get(keys.get(index)) or NOVEL_ALLELE)
+    return profile
+
 
+def classify_profile(
+    input_json: dict[str, Any],
+    profiles: ProfileStore,
+    scheme: dict[str, Any],
+    alleles: AlleleIndex,
+    hash_size: int,
+) -> dict[str, Any]:
+    profile: list[int] = build_query_profile(input_json["code"], alleles, hash_size)
     st: str = input_json["st"]
-    with lzma.open(profiles_json, "rt") as profiles_fh:
-        profiles: dict[str, Any] = json.load(profiles_fh)
-    with open(scheme_toml, "r") as scheme_fh:
-        scheme: dict[str, Any] = toml.load(scheme_fh)
     best_matches: list[dict[str, Any]] = (
-        get_exact_match(input_json["st"], profiles)
-        if input_json["st"].isdigit()
+        get_exact_match(st, profiles)
+        if st.isdigit()
         else closest_profiles(profile, profiles)
     )
 
     output = partial(build_result, len(profile))
 
     if len(best_matches) == 0:
-        print(json.dumps(output(input_json["st"])))
-    elif input_json["st"].isdigit():
+        return output(st)
+    elif st.isdigit():
         match: dict[str, Any] = best_matches[0]
-        print(
-            json.dumps(
-                output(
-                    cgst=st,
-                    matches=best_matches,
-                    identical=0,
-                    identity=100,
-                    closest_cgst=st,
-                    lincode=match["LINcode"],
-                    clonal_group=match["Clonal Group"],
-                    sublineage=match["Sublineage"],
-                )
-            )
+        return output(
+            cgst=st,
+            matches=best_matches,
+            identical=0,
+            identity=100,
+            closest_cgst=st,
+            lincode=match["LINcode"],
+            clonal_group=match["Clonal Group"],
+            sublineage=match["Sublineage"],
         )
     else:
         identity: float = best_matches[0]["identity"]
-        lincode_bin: int = assign_bin(identity, scheme["levels"])
+        lincode_bin: int = assign_bin(identity, scheme["level_thresholds"])
         lincode: list[str] = ["*"] * 10
         for i in range(lincode_bin + 1):
             lincode[i] = best_matches[0]["LINcode"][i]
-        print(
-            json.dumps(
-                output(
-                    cgst=best_matches[0]["st"] if 9 == lincode_bin else st,
-                    matches=best_matches,
-                    identical=best_matches[0]["identical"],
-                    identity=best_matches[0]["identity"],
-                    closest_cgst="/".join(
-                        sorted([match["st"] for match in best_matches])
-                    ),
-                    lincode=lincode,
-                    clonal_group=best_matches[0]["Clonal Group"]
-                    if 2 < lincode_bin
-                    else "",
-                    sublineage=best_matches[0]["Sublineage"] if 1 < lincode_bin else "",
-                )
-            ),
-            file=sys.stdout,
+        return output(
+            cgst=best_matches[0]["st"] if 9 == lincode_bin else st,
+            matches=best_matches,
+            identical=best_matches[0]["identical"],
+            identity=best_matches[0]["identity"],
+            closest_cgst="/".join(sorted([match["st"] for match in best_matches])),
+            lincode=lincode,
+            clonal_group=best_matches[0]["Clonal Group"] if 2 < lincode_bin else "",
+            sublineage=best_matches[0]["Sublineage"] if 1 < lincode_bin else "",
         )
 
 
-def get_profiles(scheme_name: str) -> dict[str, Any]:
-    with open(f"{scheme_name}.json", "r") as scheme_fh:
-        return json.load(scheme_fh)
-
-
 def read_input() -> dict[str, Any]:
-    json_str: str = ""
-    for line in sys.stdin:
-        json_str += line
-    return json.loads(json_str)
+    return orjson.loads(sys.stdin.buffer.read())
 
 
 def calculate_identity(loci_count: int, identical: int, skipped_loci: int) -> float:
@@ -159,99 +211,159 @@ def calculate_identity(loci_count: int, identical: int, skipped_loci: int) -> fl
 
 
 def build_match(
-    st: str, identical: int, identity: float, skipped_loci: int, profile: dict[str, Any]
+    profiles: ProfileStore,
+    row: int,
+    identical: int,
+    identity: float,
+    skipped_loci: int,
 ) -> dict[str, Any]:
     return {
-        "st": st,
+        "st": str(profiles.sts[row]),
         "identical": identical,
         "identity": identity,
-        "compared_loci": len(profile["profile"]) - skipped_loci,
-        "LINcode": profile["LINcode"],
-        "Sublineage": profile["Sublineage"],
-        "Clonal Group": profile["Clonal Group"],
+        "compared_loci": profiles.scheme_size - skipped_loci,
+        "LINcode": decode_lincode(profiles.lincodes[row]),
+        "Sublineage": str(profiles.sublineages[row]),
+        "Clonal Group": str(profiles.clonal_groups[row]),
     }
 
 
 def compare_profiles(
-    query: list[str],
-    reference: list[str],
+    query: np.ndarray,
+    references: np.ndarray,
+    reference_missing: np.ndarray,
     gathering_threshold: int,
     max_missing_loci: int = 29,
-) -> tuple[bool, int, int]:
-    identical: int = 0
-    mismatches: int = 0
-    skipped_loci: int = 0
-    for i, q_allele in enumerate(query):
-        # Skip positions that are blank. The match quality is shown by the number of compared loci.
-        if q_allele == "" or reference[i] == "N":
-            skipped_loci += 1
-            if max_missing_loci < skipped_loci:
-                return False, 0, 0
-            continue
-        if q_allele == reference[i]:
-            identical += 1
-        else:
-            mismatches += 1
-            if mismatches > gathering_threshold:
-                return (
-                    False,
-                    0,
-                    0,
-                )
-    return True, identical, skipped_loci
+) -> tuple[np.ndarray, np.ndarray]:
+    """Count the identical and skipped loci of the query against each profile column."""
+    # Profiles past either limit may be abandoned and reported with every locus skipped
+    loci: np.ndarray = np.flatnonzero(query != MISSING_ALLELE)
+    if _kernels.NUMBA_AVAILABLE:
+        identical: np.ndarray = np.empty(references.shape[1], dtype=np.int32)
+        skipped: np.ndarray = np.empty(references.shape[1], dtype=np.int32)
+        _kernels.scan(
+            query[loci],
+            loci,
+            references,
+            identical,
+            skipped,
+            gathering_threshold,
+            max_missing_loci,
+        )
+        return identical, skipped
+    # A locus is skipped if either side is missing, a popcount of the OR of the masks
+    skipped = np.bitwise_count(reference_missing | pack_missing_loci(query)).sum(
+        axis=1, dtype=np.int32
+    )
+    # An equal allele can only be missing on both sides, so present loci suffice
+    identical = np.count_nonzero(references[loci] == query[loci, None], axis=0)
+    return identical, skipped
 
 
 def closest_profiles(
-    query_profile: list[str], profiles: dict[str, Any]
+    query_profile: list[int],
+    profiles: ProfileStore,
+    max_missing_loci: int = 29,
 ) -> list[dict[str, Any]]:
-    scheme_size = len(query_profile)
-    closest_matches: list[dict[str, Any]] = []
-    current_closest_identity: float = 0
-    current_closest_mismatches: int = scheme_size
-    current_gathering_threshold: int = (
-        scheme_size  # Reduce the number of identity calculations
-    )
-    percent_id = partial(calculate_identity, scheme_size)
-    for st in profiles.keys():
-        matched: bool
-        identical: int
-        skipped_loci: int
-        matched, identical, skipped_loci = compare_profiles(
-            query_profile, profiles[st]["profile"], current_gathering_threshold
+    scheme_size: int = len(query_profile)
+    if scheme_size != profiles.scheme_size:
+        raise ValueError(
+            f"Query profile has {scheme_size} loci, "
+            f"but the scheme has {profiles.scheme_size}"
         )
-        if not matched:
-            continue
-        identity: float = percent_id(identical, skipped_loci)
-        mismatches: int = scheme_size - skipped_loci - identical
-        if current_closest_identity < identity:
-            closest_matches = [
-                build_match(st, identical, identity, skipped_loci, profiles[st])
-            ]
-            current_closest_identity = identity
-            current_closest_mismatches = mismatches
-            current_gathering_threshold = math.ceil(current_closest_mismatches * 1.05)
-        elif current_closest_identity == identity:
-            closest_matches.append(
-                build_match(st, identical, identity, skipped_loci, profiles[st])
-            )
-            if mismatches < current_closest_mismatches:
-                current_closest_mismatches = mismatches
-                current_gathering_threshold = math.ceil(
-                    current_closest_mismatches * 1.05
-                )
-    return closest_matches
+    query: np.ndarray = np.asarray(query_profile, dtype=np.int32)
+    rows: np.ndarray | None = profiles.exact_match_candidates(query)
+    # Each distinct profile is compared once and the counts expanded to every row
+    if rows is None:
+        rows = np.arange(len(profiles.sts))
+        row_groups: np.ndarray = profiles.profile_groups
+        references, missing_loci = profiles.unique_profiles, profiles.missing_loci
+    else:
+        groups, row_groups = np.unique(
+            profiles.profile_groups[rows], return_inverse=True
+        )
+        references = np.ascontiguousarray(profiles.unique_profiles[:, groups])
+        missing_loci = profiles.missing_loci[groups]
+    identical, skipped = compare_profiles(
+        query,
+        references,
+        missing_loci,
+        seed_gathering_threshold(query, profiles, max_missing_loci),
+        max_missing_loci,
+    )
+    identical, skipped = identical[row_groups], skipped[row_groups]
+    mismatches: np.ndarray = scheme_size - skipped - identical
+    matched: np.ndarray = skipped <= max_missing_loci
+    if not matched.any():
+        return []
+    # Only profiles within 5% of the fewest mismatches can reach the best identity,
+    # as the compared loci count varies by at most max_missing_loci.
+    candidates: np.ndarray = np.flatnonzero(
+        matched & (mismatches <= gathering_threshold(int(mismatches[matched].min())))
+    )
+    best_identity: float = 0
+    best_matches: list[tuple[int, int, int]] = []
+    for row, row_identical, row_skipped in zip(
+        rows[candidates].tolist(),
+        identical[candidates].tolist(),
+        skipped[candidates].tolist(),
+    ):
+        identity: float = calculate_identity(scheme_size, row_identical, row_skipped)
+        if best_identity < identity:
+            best_identity = identity
+            best_matches = [(row, row_identical, row_skipped)]
+        elif best_identity == identity:
+            best_matches.append((row, row_identical, row_skipped))
+    return [
+        build_match(profiles, row, row_identical, best_identity, row_skipped)
+        for row, row_identical, row_skipped in best_matches
+    ]
+
+
+def seed_gathering_threshold(
+    query: np.ndarray, profiles: ProfileStore, max_missing_loci: int
+) -> int:
+    """Return a gathering threshold from the profiles sharing the leading loci."""
+    # Their fewest mismatches bound the fewest overall, so no candidate is pruned
+    scheme_size: int = len(query)
+    groups: np.ndarray = profiles.prefix_matches(query)
+    if len(groups) == 0:
+        return scheme_size
+    identical, skipped = compare_profiles(
+        query,
+        np.ascontiguousarray(profiles.unique_profiles[:, groups]),
+        profiles.missing_loci[groups],
+        scheme_size,
+        max_missing_loci,
+    )
+    matched: np.ndarray = skipped <= max_missing_loci
+    if not matched.any():
+        return scheme_size
+    return gathering_threshold(int((scheme_size - skipped - identical)[matched].min()))
+
+
+def gathering_threshold(mismatches: int) -> int:
+    """Integer ceil(mismatches * 1.05)."""
+    return -(-mismatches * 105 // 100)
+
+
+def get_exact_match(st: str, profiles: ProfileStore) -> list[dict[str, Any]]:
+    return [build_match(profiles, profiles.rows[st], 0, 100, 0)]
 
 
-def get_exact_match(st: str, profiles: dict[str, Any]) -> list[dict[str, Any]]:
-    return [build_match(st, 0, 100, 0, profiles[st])]
+def level_thresholds(levels: list[dict[str, float]]) -> list[float]:
+    """Return the lowest identity reaching each level, its own or a finer max."""
+    thresholds: list[float] = []
+    lowest: float = math.inf
+    for level in reversed(levels):
+        lowest = min(lowest, level["max"])
+        thresholds.append(lowest)
+    return thresholds[::-1]
 
 
-def assign_bin(identity: float, levels: list[dict[str, float]]) -> int:
-    for i in range(len(levels)):
-        level: int = 9 - i
-        if identity >= levels[level]["max"]:
-            return level
-    return -1
+def assign_bin(identity: float, thresholds: list[float]) -> int:
+    """Return the finest level whose max the identity reaches, or -1 if none."""
+    return bisect.bisect_right(thresholds, identity) - 1
 
 
 def build_result(
@@ -11,6 +11,9 @@ from rauth import OAuth1Service, OAuth1Session
 
 logger = logging.getLogger(__name__)
 
+AUTHORISE_ACTION: re.Pattern = re.compile(r"authorizeClient")
+VERIFICATION_CODE: re.Pattern = re.compile(r"Verification code:")
+
 
 @dataclasses.dataclass
 class KeyCache:
@@ -192,7 +195,7 @@ class KeyCache:
             self.delete_key("request", host)
             return self.fetch_access_key(host, database)
         auth_soup = BeautifulSoup(auth_response.text, "html.parser")
-        auth_form = auth_soup.find("form", action=re.compile(r"authorizeClient"))
+        auth_form = auth_soup.find("form", action=AUTHORISE_ACTION)
         if not auth_form:
             logger.error("Could not find authorisation form")
             logger.debug(f"Response content: {auth_response.text}")
@@ -209,7 +212,7 @@ class KeyCache:
         final_response = session.post(verifier_url, data=auth_data, allow_redirects=True)
 
         final_soup = BeautifulSoup(final_response.text, "html.parser")
-        verifier_tag = final_soup.find("b", string=re.compile(r"Verification code:"))
+        verifier_tag = final_soup.find("b", string=VERIFICATION_CODE)
 
         if verifier_tag:
             verifier = verifier_tag.string.split(":")[1].strip()
@@ -0,0 +1,146 @@
+import dataclasses
+from hashlib import blake2b
+from pathlib import Path
+
+import numpy as np
+
+MISSING_ALLELE: int = 0  # Blank query loci and 'N' reference loci
+NOVEL_ALLELE: int = -1  # Query alleles not in the DB, never equal to a reference allele
+UNASSIGNED_LINCODE: int = -1  # A '*' LINcode level
+MAX_ALLELE: int = np.iinfo(np.int32).max  # Largest allele id the store can hold
+PREFIX_LOCI: int = 32  # Leading loci used to find likely close profiles first
+
+
+def encode_alleles(alleles: np.ndarray) -> np.ndarray:
+    """Encode allele id strings as int32, with blank and 'N' alleles as missing."""
+    return np.where((alleles == "") | (alleles == "N"), "0", alleles).astype(np.int32)
+
+
+def encode_lincodes(lincodes: list[str]) -> np.ndarray:
+    """Encode LINcodes as an int32 (n_profiles, levels) matrix, '*' as unassigned."""
+    codes: np.ndarray = np.array([lincode.split("_") for lincode in lincodes])
+    return np.where(codes == "*", str(UNASSIGNED_LINCODE), codes).astype(np.int32)
+
+
+def decode_lincode(lincode: np.ndarray) -> list[str]:
+    return [
+        "*" if code == UNASSIGNED_LINCODE else str(code) for code in lincode.tolist()
+    ]
+
+
+def pack_missing_loci(profiles: np.ndarray) -> np.ndarray:
+    """Bitpack the missing loci of a profile, or of each matrix row, into uint64s."""
+    packed: np.ndarray = np.packbits(profiles == MISSING_ALLELE, axis=-1)
+    padding: list[tuple[int, int]] = [(0, 0)] * (packed.ndim - 1) + [
+        (0, -packed.shape[-1] % 8)
+    ]
+    return np.ascontiguousarray(np.pad(packed, padding)).view(np.uint64)
+
+
+def profile_key(alleles: np.ndarray) -> int:
+    """A 64-bit hash of an allele vector, to find equal profiles by binary search."""
+    return int.from_bytes(
+        blake2b(
+            np.ascontiguousarray(alleles, dtype=np.int32).tobytes(), digest_size=8
+        ).digest(),
+        "little",
+    )
+
+
+def index_profiles(profiles: np.ndarray) -> dict[str, np.ndarray]:
+    """Build the classification indexes of the loci-major allele matrix."""
+    # Identical profiles are grouped so that each group is only compared once
+    unique_profiles, profile_groups = np.unique(profiles, axis=1, return_inverse=True)
+    unique_profiles = np.ascontiguousarray(unique_profiles)
+    exact_keys: np.ndarray = np.array(
+        [profile_key(profile) for profile in unique_profiles.T], dtype=np.uint64
+    )
+    prefix_keys: np.ndarray = np.array(
+        [profile_key(profile) for profile in unique_profiles[:PREFIX_LOCI].T],
+        dtype=np.uint64,
+    )
+    exact_groups: np.ndarray = np.argsort(exact_keys, kind="stable")
+    prefix_groups: np.ndarray = np.argsort(prefix_keys, kind="stable")
+    return {
+        "unique_profiles": unique_profiles,
+        "profile_groups": profile_groups.reshape(-1),
+        # Per-group packed missing loci, one row of uint64 lanes per unique profile
+        "missing_loci": pack_missing_loci(unique_profiles.T),
+        "incomplete_rows": np.flatnonzero((profiles == MISSING_ALLELE).any(axis=0)),
+        "exact_keys": exact_keys[exact_groups],
+        "exact_groups": exact_groups,
+        "prefix_keys": prefix_keys[prefix_groups],
+        "prefix_groups": prefix_groups,
+    }
+
+
+def write_profiles(file: Path, profiles: dict[str, np.ndarray]) -> None:
+    """Write the profile columns, with the allele matrix replaced by its indexes."""
+    columns: dict[str, np.ndarray] = {
+        name: column for name, column in profiles.items() if name != "profiles"
+    }
+    with open(file, "wb") as profiles_fh:
+        # Left uncompressed, as it is read on every classify run
+        np.savez(profiles_fh, **columns, **index_profiles(profiles["profiles"]))
+
+
+@dataclasses.dataclass
+class ProfileStore:
+    sts: np.ndarray
+    lincodes: np.ndarray
+    sublineages: np.ndarray
+    clonal_groups: np.ndarray
+    unique_profiles: np.ndarray
+    profile_groups: np.ndarray
+    missing_loci: np.ndarray
+    incomplete_rows: np.ndarray
+    exact_keys: np.ndarray
+    exact_groups: np.ndarray
+    prefix_keys: np.ndarray
+    prefix_groups: np.ndarray
+
+    def __post_init__(self) -> None:
+        self.rows: dict[str, int] = {
+            st: row for row, st in enumerate(self.sts.tolist())
+        }
+
+    @classmethod
+    def load(cls, file: Path) -> "ProfileStore":
+        with np.load(file) as store:
+            return cls(**{name: store[name] for name in store.files})
+
+    @property
+    def scheme_size(self) -> int:
+        return self.unique_profiles.shape[0]
+
+    def exact_match_candidates(self, query: np.ndarray) -> np.ndarray | None:
+        """Return the rows that can tie with an exact match of the query, or None."""
+        # Only an equal or incomplete profile can be 100% identical to a complete query
+        if (query == MISSING_ALLELE).any():
+            return None
+        groups: np.ndarray = self.find_groups(
+            self.exact_keys, self.exact_groups, query, self.scheme_size
+        )
+        if len(groups) == 0:
+            return None
+        return np.union1d(
+            np.flatnonzero(self.profile_groups == groups[0]), self.incomplete_rows
+        )
+
+    def prefix_matches(self, query: np.ndarray) -> np.ndarray:
+        """Return the groups sharing the query's leading loci."""
+        return self.find_groups(
+            self.prefix_keys, self.prefix_groups, query, PREFIX_LOCI
+        )
+
+    def find_groups(
+        self, keys: np.ndarray, groups: np.ndarray, query: np.ndarray, loci: int
+    ) -> np.ndarray:
+        """Return the groups whose leading loci equal the query's."""
+        key: int = profile_key(query[:loci])
+        start: int = np.searchsorted(keys, key, side="left")
+        end: int = np.searchsorted(keys, key, side="right")
+        candidates: np.ndarray = groups[start:end]
+        return candidates[
+            (self.unique_profiles[:loci, candidates] == query[:loci, None]).all(axis=0)
+        ]
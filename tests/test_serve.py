@@ -0,0 +1,63 @@
+import shutil
+from pathlib import Path
+
+import orjson
+from typer.testing import CliRunner
+
+from plincer.allelestore import write_allele_index
+from plincer.build import parse_profile_csv
+from plincer.classify import app
+from plincer.profilestore import write_profiles
+
+SCHEME_TOML: Path = Path(__file__).parents[1] / "scheme.toml"
+LOCI: int = 40
+
+
+def write_store(directory: Path) -> tuple[Path, Path, Path]:
+    header: str = "\t".join(
+        ["ST"]
+        + [f"locus{i}" for i in range(LOCI)]
+        + ["LINcode", "Phylogroup", "Sublineage", "Clonal Group"]
+    )
+    rows: list[str] = [
+        "\t".join(
+            [str(st)]
+            + [str(st + i) for i in range(LOCI)]
+            + [f"{st}_0_0_0_0_0_0_0_0_0", "Kp1", f"SL{st}", f"CG{st}"]
+        )
+        for st in (1, 2, 3)
+    ]
+    profiles_file: Path = directory / "profiles.npz"
+    write_profiles(profiles_file, parse_profile_csv([header] + rows))
+    alleles_file: Path = directory / "alleles.npy"
+    write_allele_index(alleles_file, [(bytes(8), 0, 1)], 15)
+    scheme_file: Path = directory / "scheme.toml"
+    shutil.copy(SCHEME_TOML, scheme_file)
+    return scheme_file, profiles_file, alleles_file
+
+
+def test_serve_reports_bad_lines_and_continues(tmp_path: Path) -> None:
+    scheme_file, profiles_file, alleles_file = write_store(tmp_path)
+    good: bytes = orjson.dumps(
+        {"st": "", "code": "_".join(str(1 + i) for i in range(LOCI))}
+    )
+    result = CliRunner().invoke(
+        app,
+        [
+            "serve",
+            "-s",
+            str(scheme_file),
+            "-p",
+            str(profiles_file),
+            "-a",
+            str(alleles_file),
+        ],
+        input=b"\n".join([good, b"not json", good]) + b"\n",
+    )
+    assert result.exit_code == 0, result.output
+    outputs: list[dict] = [orjson.loads(line) for line in result.stdout.splitlines()]
+    assert len(outputs) == 3
+    assert "error" in outputs[1]
+    for output in (outputs[0], outputs[2]):
+        assert output["identity"] == 100
+        assert output["Closest cgST"] == "1"